@@ -1,8 +1,8 @@
 import vamp
-import librosa
 import csv
 import argparse
 import numpy as np
+import soundfile as sf
 
 
 def mono_anal(y, fs):
@@ -50,23 +50,22 @@ def mono_anal(y, fs):
     return output['vector']
 
 def trim_pitch_track_end(pitch_track):
-    i=0
+    pitch_track = np.asarray(pitch_track)
+    last = len(pitch_track) - 1
+    if last < 0:
+        return pitch_track, 0
     #find first positive
-    while (pitch_track[i] < 0):
-        if i == len(pitch_track) - 1:
-            break
-        i += 1
+    started = pitch_track >= 0
+    st = int(started.argmax()) if started.any() else last
     #then find first negative
-    st = i
-    while (pitch_track[i] > 0):
-        if i == len(pitch_track) - 1:
-            break
-        i += 1
-    end = i
+    stopped = pitch_track[st:] <= 0
+    end = st + int(stopped.argmax()) if stopped.any() else last
     return pitch_track[st:end], st
 
 def main(args):
-    y, fs = librosa.load(args.wav_path, sr=None)
+    y, fs = sf.read(args.wav_path, dtype='float32')
+    if y.ndim > 1:
+        y = y.mean(axis=1)
     t_step, pitch_track = mono_anal(y, fs)
     pitch_track_trimed, st = trim_pitch_track_end(pitch_track)
     p_time = np.arange(len(pitch_track_trimed)) * float(t_step) + args.seg_start_time
@@ -76,10 +75,10 @@ def main(args):
     on_time = p_time[0]
     off_time = p_time[-1]
     
+    pitch_out = pitch_track_trimed[st:-1]
     with open(args.pt_path, 'a') as pt:
-        writer = csv.writer(pt, delimiter=',')
-        for t, f in zip(p_time, pitch_track_trimed[st:-1]):
-            writer.writerow([t,f])
+        np.savetxt(pt, np.column_stack([p_time[:len(pitch_out)], pitch_out]),
+                   delimiter=',', fmt='%.6f')
     
 
     with open(args.onoff_path, 'a') as onoff:
@@ -3,9 +3,16 @@ import librosa
 import csv
 import argparse
 import numpy as np
+import soundfile as sf
 
-def offset_anal(y, fs):
-    """Run pyin on an audio signal y.
+try:
+    import numpy_rms
+except ImportError:
+    numpy_rms = None
+
+def pyin_anal(y, fs, step_size=256, block_size=2048):
+    """Run pyin once on an audio signal y, collecting both the voiced
+    probability and the smoothed pitch track.
 
     Parameters
     ----------
@@ -13,98 +20,85 @@ def offset_anal(y, fs):
         audio signal
     fs : float
         audio sample rate
-    param : dict default=None
-        threshdistr : int, default=2
-            Yin threshold distribution identifier.
-                - 0 : uniform
-                - 1 : Beta (mean 0.10)
-                - 2 : Beta (mean 0.15)
-                - 3 : Beta (mean 0.20)
-                - 4 : Beta (mean 0.30)
-                - 5 : Single Value (0.10)
-                - 6 : Single Value (0.15)
-                - 7 : Single Value (0.20)
-        outputunvoiced : int, default=0
-            Output estimates classified as unvoiced?
-                - 0 : No
-                - 1 : Yes
-                - 2 : Yes, as negative frequencies
-        precisetime : int, default=0
-            If 1, use non-standard precise YIN timing (slow)
-        lowampsuppression : float, default=0.005
-            Threshold between 0 and 1 to supress low amplitude pitch estimates.
-
+    step_size : int, default=256
+        pyin hop size in samples
+    block_size : int, default=2048
+        pyin frame size in samples
+
+    Returns
+    -------
+    t_step : float
+        time between frames in seconds
+    vp : np.array
+        voiced probability
+    pt : np.array
+        smoothed pitch track
 
     """
 
+    # outputunvoiced only affects the pitch track, not the voiced
+    # probability
     param = {"threshdistr": 2,
              "lowampsuppression": 0.08,
+             "outputunvoiced": 1,
              "precisetime": 0,
              "prunethresh": 0.05,
              "onsetsensitivity": 0.8}
 
-    vp = vamp.collect(y, fs, 'pyin:pyin', output='voicedprob', parameters=param)
-
-    return vp['vector']
-
-def pt_anal(y, fs):
-    """Run pyin on an audio signal y.
+    outputs = ['voicedprob', 'smoothedpitchtrack']
+    vectors = {o: [] for o in outputs}
+    for feature in vamp.process_audio_multiple_outputs(
+            y, fs, 'pyin:pyin', outputs, parameters=param,
+            step_size=step_size, block_size=block_size):
+        for o, f in feature.items():
+            vectors[o].append(f['values'][0])
 
-    Parameters
-    ----------
-    y : np.array
-        audio signal
-    fs : float
-        audio sample rate
-    param : dict default=None
-        threshdistr : int, default=2
-            Yin threshold distribution identifier.
-                - 0 : uniform
-                - 1 : Beta (mean 0.10)
-                - 2 : Beta (mean 0.15)
-                - 3 : Beta (mean 0.20)
-                - 4 : Beta (mean 0.30)
-                - 5 : Single Value (0.10)
-                - 6 : Single Value (0.15)
-                - 7 : Single Value (0.20)
-        outputunvoiced : int, default=0
-            Output estimates classified as unvoiced?
-                - 0 : No
-                - 1 : Yes
-                - 2 : Yes, as negative frequencies
-        precisetime : int, default=0
-            If 1, use non-standard precise YIN timing (slow)
-        lowampsuppression : float, default=0.005
-            Threshold between 0 and 1 to supress low amplitude pitch estimates.
+    t_step = float(step_size) / fs
+    return (t_step, np.asarray(vectors['voicedprob']),
+            np.asarray(vectors['smoothedpitchtrack']))
 
+def frame_rms(y, frame_length=2048, hop_length=256):
+    """Frame-wise rms of y, matching `librosa.feature.rmse(y=y)[0]`.
 
+    If `numpy_rms` is installed, the rms of each hop-sized block is computed
+    in SIMD C and blocks are averaged into (centered) frames; otherwise this
+    falls back to librosa.
     """
-
-    param = {"threshdistr": 2,
-             "lowampsuppression": 0.08,
-             "outputunvoiced": 1,
-             "precisetime": 0,
-             "prunethresh": 0.05,
-             "onsetsensitivity": 0.8}
-
-    pt_output = vamp.collect(y, fs, 'pyin:pyin', output='smoothedpitchtrack', parameters=param)
-    
-    return pt_output['vector']
+    n_blocks = frame_length // hop_length
+    n_frames = 1 + len(y) // hop_length
+    if numpy_rms is None or frame_length % hop_length or len(y) <= frame_length // 2:
+        return librosa.feature.rmse(y=y, frame_length=frame_length,
+                                    hop_length=hop_length)[0]
+
+    y_pad = np.pad(y, int(frame_length // 2), mode='reflect')
+    block_ms = numpy_rms.rms(np.ascontiguousarray(y_pad, dtype=np.float32),
+                             hop_length).astype(np.float64)**2
+    ms_sum = np.concatenate([[0.0], np.cumsum(block_ms)])
+    frame_ms = (ms_sum[n_blocks:n_blocks + n_frames] - ms_sum[:n_frames]) / n_blocks
+    return np.sqrt(np.maximum(frame_ms, 0.0))
 
 def segment_offset(seg, sr, seg_start_time, verbose=False):
-    t_step, vp = offset_anal(seg, sr)
-    t_step, pt = pt_anal(seg, sr)
-    rms = librosa.feature.rmse(y=seg, hop_length=256)[0]
+    t_step, vp, pt = pyin_anal(seg, sr)
+    rms = frame_rms(seg, hop_length=256)
     min_idx = min(len(vp), len(rms))
     vp = vp[0:min_idx] + 1e-12
     rms = rms[0:min_idx]
     
-    log_offset_prob = -np.log(rms * vp)
+    # -log(rms * vp), computed in place in a single buffer. Silent frames
+    # are set to +inf directly rather than through a divide-by-zero log.
+    log_offset_prob = np.multiply(rms, vp)
+    audible = log_offset_prob > 0
+    np.log(log_offset_prob, out=log_offset_prob, where=audible)
+    np.negative(log_offset_prob, out=log_offset_prob)
+    log_offset_prob[~audible] = np.inf
     
     
     offset_frame = 10 # start checking at around 58 ms.
-    while offset_frame < len(log_offset_prob) and log_offset_prob[offset_frame] < 8.5:
-        offset_frame += 1;
+    crossed = ~(log_offset_prob[offset_frame:] < 8.5)
+    if crossed.any():
+        offset_frame += int(crossed.argmax())
+    else:
+        offset_frame = max(offset_frame, len(log_offset_prob))
     
     offset_time = librosa.frames_to_time(offset_frame, hop_length=256, sr=sr) + seg_start_time
 
@@ -132,13 +126,15 @@ def segment_offset(seg, sr, seg_start_time, verbose=False):
 
 
 def main(args):
-    y, sr = librosa.load(args.wav_path, sr=None)
+    y, sr = sf.read(args.wav_path, dtype='float32')
+    if y.ndim > 1:
+        y = y.mean(axis=1)
     offset_time, pitch_track, t_step = segment_offset(y, sr, args.seg_start_time)
     
+    p_time = args.seg_start_time + np.arange(len(pitch_track)) * float(t_step)
     with open(args.pt_path, 'a') as pt:
-        writer = csv.writer(pt, delimiter=',')
-        for i, f in enumerate(pitch_track):
-            writer.writerow([args.seg_start_time + i*float(t_step) , f])
+        np.savetxt(pt, np.column_stack([p_time, pitch_track]),
+                   delimiter=',', fmt='%.6f')
     
 
     with open(args.onoff_path, 'a') as onoff:
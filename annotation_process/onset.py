@@ -4,6 +4,7 @@ import numpy as np
 import pretty_midi
 import jams
 import os
+import copy
 import argparse
 
 def rough_midi(args):
@@ -32,11 +33,24 @@ def rough_midi(args):
     return 0
 
 
+_tempo_templates = {}
+
+def load_tempo_template(path='tempo_template.mid'):
+    # parse the template once, hand out copies
+    if path not in _tempo_templates:
+        _tempo_templates[path] = pretty_midi.PrettyMIDI(path)
+    return copy.deepcopy(_tempo_templates[path])
+
 def build_midi_from_output(pyin_note_output):
-    midi = pretty_midi.PrettyMIDI('tempo_template.mid')
+    midi = load_tempo_template()
     ch = pretty_midi.Instrument(program=25)
-    for note in pyin_note_output:
-        pitch = int(round(librosa.hz_to_midi(note['values'])[0]))
+    ch.notes = [None] * len(pyin_note_output)
+    # convert all note frequencies in one call
+    freqs = np.asarray([note['values'][0] for note in pyin_note_output],
+                       dtype=np.float64)
+    pitches = np.rint(librosa.hz_to_midi(freqs)).astype(int)
+    for i, (note, pitch) in enumerate(zip(pyin_note_output, pitches)):
+        pitch = int(pitch)
         st = float(note['timestamp'])
         dur = float(note['duration'])
 #         print(pitch, st, dur )
@@ -46,7 +60,7 @@ def build_midi_from_output(pyin_note_output):
             end=st+dur
         )
 
-        ch.notes.append(n)
+        ch.notes[i] = n
 #         bend_amount = int(round((note.value - pitch) * 4096))
 #         pb = pretty_midi.PitchBend(pitch=bend_amount*q, time=st)
 #         ch.pitch_bends.append(pb)
@@ -3,8 +3,62 @@ import librosa
 import csv
 import argparse
 import numpy as np
+import soundfile as sf
+import numba
 import jams
-
+from joblib import Parallel, delayed
+
+
+@numba.njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _offset_flux(S, ref_spec, lag, out):
+    # out[f, t] = max(0, ref_spec[f, t] - S[f, t + lag]) in a single pass.
+    # max() keeps the inner loop branchless so it vectorizes.
+    for f in numba.prange(S.shape[0]):
+        for t in range(S.shape[1] - lag):
+            out[f, t] = max(ref_spec[f, t] - S[f, t + lag], 0.0)
+
+
+@numba.njit(fastmath=True, cache=True)
+def _offset_peak_signal(rms_diff, offset_str, rms, out):
+    # out[i] = max(0, rms_diff[i] * offset_str[i] / rms[i]) in a single pass
+    for i in range(out.shape[0]):
+        v = rms_diff[i] * offset_str[i] / rms[i]
+        out[i] = v if v > 0.0 else 0.0
+
+
+@numba.njit(cache=True)
+def _peak_pick(x, pre_max, post_max, pre_avg, post_avg, delta, wait):
+    # Same detections as librosa.util.peak_pick: x[n] is the max of
+    # x[n - pre_max:n + post_max], at least delta above the mean of
+    # x[n - pre_avg:n + post_avg] (both truncated at the edges), and more
+    # than `wait` samples after the previous peak.
+    n = x.shape[0]
+    peaks = np.empty(n, dtype=np.int64)
+    n_peaks = 0
+    last_onset = -wait - 1
+    for i in range(n):
+        v = x[i]
+        if v == 0.0 or v != v:
+            continue
+        is_max = True
+        for j in range(max(0, i - pre_max), min(n, i + post_max)):
+            if x[j] > v:
+                is_max = False
+                break
+        if not is_max:
+            continue
+        lo = max(0, i - pre_avg)
+        hi = min(n, i + post_avg)
+        acc = 0.0
+        for j in range(lo, hi):
+            acc += x[j]
+        if v < acc / (hi - lo) + delta:
+            continue
+        if i > last_onset + wait:
+            peaks[n_peaks] = i
+            n_peaks += 1
+            last_onset = i
+    return peaks[:n_peaks]
 
 def offset_strength_multi(y=None, sr=22050, S=None, lag=1, max_size=1,
                          detrend=False, center=True, feature=None,
@@ -139,11 +193,11 @@ def offset_strength_multi(y=None, sr=22050, S=None, lag=1, max_size=1,
     else:
         ref_spec = scipy.ndimage.maximum_filter1d(S, max_size, axis=0)
 
-    # Compute difference to the reference, spaced by lag
-    onset_env = S[:, lag:] - ref_spec[:, :-lag]
-
-    # Discard negatives (decreasing amplitude)
-    onset_env = np.maximum(0.0, -1 * onset_env)
+    # Compute difference to the reference, spaced by lag, and
+    # discard negatives (increasing amplitude) without temporaries
+    onset_env = np.empty((S.shape[0], max(S.shape[1] - lag, 0)),
+                         dtype=np.result_type(S.dtype, np.float32))
+    _offset_flux(S, ref_spec, lag, onset_env)
 
     # Aggregate within channels
     pad = True
@@ -163,53 +217,102 @@ def offset_strength_multi(y=None, sr=22050, S=None, lag=1, max_size=1,
         # Counter-act framing effects. Shift the onsets by n_fft / hop_length
         pad_width += n_fft // (2 * hop_length)
 
-    onset_env = np.pad(onset_env, ([0, 0], [int(pad_width), 0]),
-                       mode='constant')
+    pad_width = int(pad_width)
+    n_out = onset_env.shape[1] + pad_width
+
+    # Trim to match the input duration. The detrending filter is causal,
+    # so trimming before it leaves the kept frames unchanged.
+    if center:
+        n_out = min(n_out, S.shape[1])
+
+    # Write the shifted envelope straight into its final-sized buffer
+    padded = np.zeros((onset_env.shape[0], n_out), dtype=onset_env.dtype)
+    padded[:, pad_width:] = onset_env[:, :max(n_out - pad_width, 0)]
+    onset_env = padded
 
     # remove the DC component
     if detrend:
         onset_env = scipy.signal.lfilter([1.0, -1.0], [1.0, -0.99],
                                          onset_env, axis=-1)
 
-    # Trim to match the input duration
-    if center:
-        onset_env = onset_env[:, :S.shape[1]]
-
     return onset_env
 
+_workspace = {}
+
+def workspace(name, shape, dtype=np.float64):
+    """Scratch array reused across calls to `segment_offset`.
+
+    Segments within a process are analyzed one at a time, so each named
+    buffer only grows to the largest segment seen and is otherwise
+    recycled. The buffers live in the module, so under joblib they persist
+    across batches only because `main` dispatches the imported
+    `stem_anal.segment_offset` (see there). Nothing returned by
+    `segment_offset` may point into it.
+    """
+    size = int(np.prod(shape))
+    buf = _workspace.get(name)
+    if buf is None or buf.size < size or buf.dtype != dtype:
+        buf = _workspace[name] = np.empty(size, dtype=dtype)
+    return buf[:size].reshape(shape)
+
+def stft_rms(D, n_fft):
+    """Frame-wise rms of a signal from the power spectrogram `D` of its
+    hann-windowed STFT.
+
+    By Parseval, the full spectrum carries `n_fft` times the energy of the
+    windowed frame; the one-sided spectrum counts every bin but DC and
+    Nyquist twice. Normalising by the periodic hann window energy
+    (`3 * n_fft / 8`) makes this comparable to `librosa.feature.rmse(y=...)`
+    computed with the same frames.
+    """
+    power = 2 * D.sum(axis=0) - D[0] - D[-1]
+    return np.sqrt(power / (n_fft * 0.375 * n_fft))
+
 def segment_offset(seg, sr, seg_start_time, verbose=False):
-    if len(seg) > sr*4:
-        seg = seg[0:int(sr*4)]
+    hop_len = 256
+    n_fft = 2048
 
-    seg, perc = librosa.effects.hpss(y=seg)
+    # at most 4 seconds, single precision for hpss / stft / pyin
+    seg = np.ascontiguousarray(seg[0:int(sr*4)], dtype=np.float32)
+
+    # too few frames for the median filters to separate anything
+    if len(seg) >= hop_len * 8:
+        seg, perc = librosa.effects.hpss(y=seg)
 
     t_step, pt = pt_anal(seg, sr)
-    hop_len = 256
 
+    # one STFT shared by the frame rms and the offset strength
+    D = np.abs(librosa.stft(seg, n_fft=n_fft, hop_length=hop_len))**2
 
-    rms = librosa.feature.rmse(y=seg, hop_length=hop_len)[0].reshape(-1,1)  + 1e-15
+    rms = workspace('rms', D.shape[1], D.dtype)
+    rms[:] = stft_rms(D, n_fft)
+    rms += 1e-15
     silence_f = rms.shape[0]-1
-    for i, e in enumerate(rms):
-        if i < 5:
-            continue
-        if e < 1e-14:
-            silence_f = i
-            break
-    rms_db = np.log(rms)
-    rms_diff = -np.diff(rms_db, axis=0)
-    offset_str = offset_strength_multi(y=seg, hop_length=hop_len, sr=sr)[0].reshape(-1,1)
+    silent = rms[5:] < 1e-14
+    if silent.any():
+        silence_f = 5 + int(silent.argmax())
+    rms_db = np.log(rms, out=workspace('rms_db', rms.shape, rms.dtype))
+    # -diff(rms_db): rms_db[i] - rms_db[i+1], written in a single pass
+    rms_diff = np.subtract(rms_db[:-1], rms_db[1:],
+                           out=workspace('rms_diff', rms_db.shape[0] - 1,
+                                         rms_db.dtype))
+    mel = librosa.feature.melspectrogram(S=D, sr=sr, fmax=11025.0)
+    offset_str = offset_strength_multi(S=librosa.core.power_to_db(mel),
+                                       hop_length=hop_len, sr=sr)[0]
     min_idx = min(rms_diff.shape[0], offset_str.shape[0])
-    rms_diff = rms_diff[:min_idx, :]
-    offset_str = offset_str[:min_idx, :]
+    rms_diff = rms_diff[:min_idx]
+    offset_str = offset_str[:min_idx]
 
-    to_peak_pick = np.maximum(rms_diff * offset_str / rms[:-1], 0.0)
-    t_vec = (np.arange(to_peak_pick.shape[0]) * float(t_step)).reshape(-1,1)
+    to_peak_pick = workspace('to_peak_pick', min_idx,
+                             np.result_type(rms_diff, offset_str, rms))
+    _offset_peak_signal(rms_diff, offset_str, rms[:min_idx], to_peak_pick)
+    t_vec = np.arange(to_peak_pick.shape[0]) * float(t_step)
 
 
 
-    offset_frames_raw = librosa.util.peak_pick(to_peak_pick.ravel(), 5, 5, 5, 7, 0.5, 10)
-    offset_frames_raw = [f for f in offset_frames_raw if to_peak_pick[f] > 2]
-    offset_frames = np.asarray([f for f in offset_frames_raw if t_vec[f] > 0.06])
+    offset_frames_raw = _peak_pick(to_peak_pick, 5, 5, 5, 7, 0.5, 10)
+    offset_frames = offset_frames_raw[(to_peak_pick[offset_frames_raw] > 2) &
+                                      (t_vec[offset_frames_raw] > 0.06)]
     if offset_frames.shape[0] == 0:
         offset_frames = [silence_f]
     offset_times = librosa.frames_to_time(offset_frames, hop_length=hop_len, sr=sr)
@@ -277,28 +380,64 @@ def pt_anal(y, fs):
              "prunethresh": 0.05,
              "onsetsensitivity": 0.8}
 
-    pt_output = vamp.collect(y, fs, 'pyin:pyin', output='smoothedpitchtrack', parameters=param)
+    plugin, step_size, block_size = pyin_plugin(y, fs, param)
+    ff = vamp.frames.frames_from_array(y, step_size, block_size)
+    results = vamp.process.process_with_initialised_plugin(
+        ff, fs, step_size, plugin, ['smoothedpitchtrack'])
+    pt = np.asarray([r['smoothedpitchtrack']['values'][0] for r in results])
+
+    return float(step_size) / fs, pt
 
-    return pt_output['vector']
+_pyin_plugins = {}
 
-def chop_sig(y, adj_on_samps):
-    y_chopt = []
-    for (i, on) in enumerate(adj_on_samps):
-        if i+1 == len(adj_on_samps):
-            end = len(y)
-        else:
-            end = adj_on_samps[i+1]
+def pyin_plugin(y, fs, param):
+    """Load and initialise pyin once per sample rate and parameter set.
 
-        y_chopt.append(y[on:end])
-    return y_chopt
+    Every segment of a stem shares the same configuration, so the plugin is
+    kept around in the module (once per worker process, as long as `main`
+    dispatches `stem_anal.segment_offset`) and only reset between segments.
+    """
+    key = (fs, np.ndim(y), tuple(sorted(param.items())))
+    if key not in _pyin_plugins:
+        _pyin_plugins[key] = vamp.load.load_and_configure(y, fs, 'pyin:pyin', param)
+    return _pyin_plugins[key]
+
+def load_segments(wavpath, onset_times, max_dur=4.0):
+    """Read the segments between consecutive onsets of a stem.
+
+    Only the first `max_dur` seconds of each segment (all that
+    `segment_offset` looks at) are read from disk, as mono float32.
+    """
+    with sf.SoundFile(wavpath) as f:
+        sr = f.samplerate
+        on_samps = np.minimum(librosa.time_to_samples(onset_times, sr=sr), f.frames)
+        ends = np.append(on_samps[1:], f.frames)
+        segs = []
+        for on, end in zip(on_samps, ends):
+            f.seek(int(on))
+            n = max(0, int(min(end, on + int(sr*max_dur)) - on))
+            seg = f.read(n, dtype='float32')
+            if seg.ndim > 1:
+                seg = seg.mean(axis=1)
+            segs.append(seg)
+    return segs, sr
+
+def pitch_rows(seg_start_time, pitch_track, t_step, voiced_only=False):
+    """(time, frequency) rows of a segment's pitch track, as a 2-d array."""
+    pitch_track = np.asarray(pitch_track)
+    p_time = seg_start_time + np.arange(len(pitch_track)) * float(t_step)
+    if voiced_only:
+        voiced = pitch_track > 0
+        p_time = p_time[voiced]
+        pitch_track = pitch_track[voiced]
+    return np.column_stack([p_time, pitch_track])
 
 def note_anal(y, fs, seg_start_time, outname):
     offset_time, pitch_track, t_step = segment_offset(y, fs, seg_start_time)
 
     with open(outname+'_pt.csv', 'a') as pt:
-        writer = csv.writer(pt, delimiter=',')
-        for i, f in enumerate(pitch_track):
-            writer.writerow([seg_start_time + i*float(t_step) , f])
+        np.savetxt(pt, pitch_rows(seg_start_time, pitch_track, t_step),
+                   delimiter=',', fmt='%.6f')
 
     with open(outname+'_onoff.csv', 'a') as onoff:
         writer = csv.writer(onoff, delimiter=',')
@@ -307,36 +446,39 @@ def note_anal(y, fs, seg_start_time, outname):
 
 def main(args):
     outname = args.outdir
-    y, sr = librosa.load(args.wavpath, sr=None)
     adjusted_onset_jam = jams.load(args.onsetjams)
     ann = adjusted_onset_jam.search(namespace='onset')[0]
     adjusted_onset_times = ann.to_event_values()[0]
-    adj_on_samps = librosa.time_to_samples(adjusted_onset_times, sr=sr)
-    y_chopt = chop_sig(y, adj_on_samps)
+    y_chopt, sr = load_segments(args.wavpath, adjusted_onset_times)
+
+    # segments are independent: analyze them across processes, then write
+    # the results from here in onset order. When run as a script this
+    # module is __main__, whose functions joblib pickles by value with fresh
+    # globals per batch; dispatching through the importable module lets each
+    # worker import it once and keep its pyin plugin between batches.
+    import stem_anal
+    results = Parallel(n_jobs=args.n_jobs, verbose=5)(
+        delayed(stem_anal.segment_offset)(seg, sr, seg_start_time)
+        for seg, seg_start_time in zip(y_chopt, adjusted_onset_times))
     print("about to clear csv files")
 
-    with open(outname+'_pt.csv', 'w') as csvfile: pass
-    with open(outname+'_onoff.csv', 'w') as csvfile: pass
-
-    k=0
-    for seg, seg_start_time in zip(y_chopt, adjusted_onset_times):
-        if k%20 == 0:
-            print(k, len(y_chopt))
-        k+=1
-
-        offset_time, pitch_track, t_step = segment_offset(seg, sr, seg_start_time)
-        with open(outname+'_pt.csv', 'a') as pt:
-            writer = csv.writer(pt, delimiter=',')
-            for i, f in enumerate(pitch_track):
-                if f > 0:
-                    writer.writerow([seg_start_time + i*float(t_step) , f])
-        with open(outname+'_onoff.csv', 'a') as onoff:
-            writer = csv.writer(onoff, delimiter=',')
-            writer.writerow([seg_start_time, offset_time])
+    # write each output once for the whole stem
+    pt_rows = [np.empty((0, 2))]
+    onoff_rows = []
+    for seg_start_time, (offset_time, pitch_track, t_step) in zip(
+            adjusted_onset_times, results):
+        pt_rows.append(pitch_rows(seg_start_time, pitch_track, t_step,
+                                  voiced_only=True))
+        onoff_rows.append([seg_start_time, offset_time])
+
+    with open(outname+'_pt.csv', 'w') as pt:
+        np.savetxt(pt, np.concatenate(pt_rows), delimiter=',', fmt='%.6f')
+    with open(outname+'_onoff.csv', 'w') as onoff:
+        writer = csv.writer(onoff, delimiter=',')
+        writer.writerows(onoff_rows)
 
     return 0
 
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='a note using pYin. appending the result to a existing csv file.')
@@ -346,6 +488,9 @@ if __name__ == '__main__':
         'outdir', type=str, help='path to the output directory + name')
     parser.add_argument(
         'onsetjams', type=str, help='onsetjams')
+    parser.add_argument(
+        '--n_jobs', type=int, default=-1,
+        help='number of segments analyzed in parallel (-1: all cores)')
 
 
     main(parser.parse_args())
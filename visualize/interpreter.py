@@ -1,108 +1,202 @@
 """interpreter
 """
+from collections import OrderedDict
 import numpy as np
 import pretty_midi
 from matplotlib import lines as mlines, pyplot as plt
-import tempfile
+from matplotlib.collections import LineCollection
+from matplotlib.markers import MarkerStyle
 import librosa
-import sox
-import os
-import pandas as pd
+import soundfile as sf
 
-def save_small_wav(out_path, y, fs):
-    fhandle, tmp_file = tempfile.mkstemp(suffix='.wav')
+# per-string plot colors, names and open-string midi pitches (low E first)
+_STYLE = ('r', 'y', 'b', '#FF7F50', 'g', '#800080')
+_STRING = ('E', 'A', 'D', 'G', 'B', 'e')
+_STR_MIDI = (40, 45, 50, 55, 59, 64)
 
-    librosa.output.write_wav(tmp_file, y, fs)
+def save_small_wav(out_path, y, fs):
+    # 16 bit wav straight from libsndfile, no temp file or sox pass
+    sf.write(out_path, np.clip(y, -1.0, 1.0).astype(np.float32, copy=False), fs,
+             subtype='PCM_16')
 
-    tfm = sox.Transformer()
-    tfm.convert(bitdepth=16)
-    tfm.build(tmp_file, out_path)
-    os.close(fhandle)
-    os.remove(tmp_file)
+def note_annotations(jam):
+    """The per-string note annotations of a jam: note_midi if present,
+    pitch_midi otherwise.
+    """
+    annos = jam.search(namespace='note_midi')
+    if len(annos) == 0:
+        annos = jam.search(namespace='pitch_midi')
+    return annos
+
+def _anno_arrays(anno):
+    # start times, durations and values of an annotation as numpy arrays
+    intervals, values = anno.to_interval_values()
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    return (intervals[:, 0], intervals[:, 1] - intervals[:, 0],
+            np.asarray(values, dtype=np.float64))
+
+_fret_markers = {}
+
+def _fret_marker(fret):
+    # mathtext fret labels are parsed into a marker path once per fret
+    fret = int(fret)
+    if fret not in _fret_markers:
+        _fret_markers[fret] = MarkerStyle("${}$".format(fret))
+    return _fret_markers[fret]
+
+def _unique_pixels(x, y, x_px, y_px):
+    # keep the first finite point falling in each (x_px, y_px) cell
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    cells = np.stack([np.floor(x / x_px), np.floor(y / y_px)], axis=1)
+    _, idx = np.unique(cells, axis=0, return_index=True)
+    idx.sort()
+    return x[idx], y[idx]
+
+def plot_beat_lines(ax, beat_anno):
+    """Draw every beat (dotted) and downbeat (solid) of a beat_position
+    annotation as full-height vertical lines, one collection for each.
+    """
+    times = np.fromiter((b.time for b in beat_anno.data), dtype=np.float64)
+    positions = np.fromiter((int(b.value['position']) for b in beat_anno.data),
+                            dtype=np.int64)
+    # x in data coordinates, y spanning the axes, like axvline
+    trans = ax.get_xaxis_transform()
+    for mask, linestyle, alpha in [(np.ones_like(positions, dtype=bool), 'dotted', 0.5),
+                                   (positions == 1, '-', 0.8)]:
+        segs = np.zeros((mask.sum(), 2, 2))
+        segs[:, :, 0] = times[mask, np.newaxis]
+        segs[:, 1, 1] = 1
+        ax.add_collection(LineCollection(segs, colors='k', linestyles=linestyle,
+                                         alpha=alpha, transform=trans),
+                          autolim=False)
 
 def jams_to_midi(jam, q=1):
     # q = 1: with pitch bend. q = 0: without pitch bend.
     midi = pretty_midi.PrettyMIDI()
-    annos = jam.search(namespace='note_midi')
-    if len(annos) == 0:
-        annos = jam.search(namespace='pitch_midi')
+    annos = note_annotations(jam)
     for anno in annos:
         midi_ch = pretty_midi.Instrument(program=25)
-        for note in anno:
-            pitch = int(round(note.value))
-            bend_amount = int(round((note.value - pitch) * 4096))
-            st = note.time
-            dur = note.duration
-            n = pretty_midi.Note(
-                velocity=100 + np.random.choice(range(-5, 5)),
-                pitch=pitch, start=st,
-                end=st + dur
-            )
-            pb = pretty_midi.PitchBend(pitch=bend_amount * q, time=st)
-            midi_ch.notes.append(n)
-            midi_ch.pitch_bends.append(pb)
+        times, durs, vals = _anno_arrays(anno)
+        # pitch / bend decomposition and velocity jitter for all notes at once
+        pitches = np.rint(vals).astype(int)
+        bends = np.rint((vals - pitches) * 4096).astype(int) * q
+        velocities = 100 + np.random.randint(-5, 5, len(vals))
+        midi_ch.notes.extend(
+            pretty_midi.Note(velocity=int(v), pitch=int(p),
+                             start=float(st), end=float(st + dur))
+            for v, p, st, dur in zip(velocities, pitches, times, durs))
+        midi_ch.pitch_bends.extend(
+            pretty_midi.PitchBend(pitch=int(b), time=float(st))
+            for b, st in zip(bends, times))
         if len(midi_ch.notes) != 0:
             midi.instruments.append(midi_ch)
     return midi
 
 
+_SYNTH_CACHE_SIZE = 8
+_synth_cache = OrderedDict()
+
+def _note_table(jam):
+    # hashable (time, duration, value) triples of every note annotation
+    annos = note_annotations(jam)
+    return tuple(tuple((float(n.time), float(n.duration), float(n.value))
+                       for n in anno)
+                 for anno in annos)
+
 def sonify_jams(jam, fpath=None, q=1):
-    midi = jams_to_midi(jam, q) # q=1 : with pitchbend
-    signal_out = midi.fluidsynth()
+    # fluidsynth is the expensive part: reuse the signal of an identical
+    # note table (the returned array is shared, hence read-only)
+    key = (_note_table(jam), q)
+    signal_out = _synth_cache.get(key)
+    if signal_out is None:
+        midi = jams_to_midi(jam, q) # q=1 : with pitchbend
+        # fluidsynth renders float64; single precision is plenty downstream
+        signal_out = midi.fluidsynth().astype(np.float32, copy=False)
+        signal_out.flags.writeable = False
+        _synth_cache[key] = signal_out
+        if len(_synth_cache) > _SYNTH_CACHE_SIZE:
+            _synth_cache.popitem(last=False)
+    else:
+        _synth_cache.move_to_end(key)
     if fpath != None:
         save_small_wav(fpath, signal_out, 44100)
     return signal_out, 44100
 
 
-def visualize_jams_note(jam, save_path=None):
-    style_dict = {0 : 'r', 1 : 'y', 2 : 'b', 3 : '#FF7F50', 4 : 'g', 5 : '#800080'}
-    string_dict = {0: 'E', 1: 'A', 2: 'D', 3: 'G', 4: 'B', 5: 'e' }
-    s = 0
+def visualize_jams_note(jam, save_path=None, ax=None):
     handle_list = []
-    fig = plt.figure()
-    annos = jam.search(namespace='note_midi')
-    if len(annos) == 0:
-        annos = jam.search(namespace='pitch_midi')
-    for string_tran in annos:
-        handle_list.append(mlines.Line2D([], [], color=style_dict[s],
-                                         label=string_dict[s]))
-        for note in string_tran:
-            start_time = note[0]
-            midi_note = note[2]
-            dur = note[1]
-            plt.plot([start_time, start_time + dur],
-                     [midi_note, midi_note],
-                     style_dict[s], label=string_dict[s])
-        s += 1
-    plt.xlabel('Time (sec)')
-    plt.ylabel('Pitch (midi note number)')
-    plt.legend(loc='center left', bbox_to_anchor=(1, 0.5), handles=handle_list)
-    plt.title(jam.file_metadata.title)
-    plt.xlim(-0.5, jam.file_metadata.duration)
-    fig.set_size_inches(6,3)
+    own_fig = ax is None
+    if own_fig:
+        fig, ax = plt.subplots(figsize=(6, 3))
+    else:
+        fig = ax.figure
+    annos = note_annotations(jam)
+    for s, string_tran in enumerate(annos):
+        handle_list.append(mlines.Line2D([], [], color=_STYLE[s],
+                                         label=_STRING[s]))
+        starts, durs, midis = _anno_arrays(string_tran)
+        # one (N, 2, 2) segment array -> one collection per string
+        segs = np.stack([np.stack([starts, midis], axis=1),
+                         np.stack([starts + durs, midis], axis=1)], axis=1)
+        ax.add_collection(LineCollection(segs, colors=_STYLE[s],
+                                         label=_STRING[s]))
+    ax.autoscale_view()
+    ax.set_xlabel('Time (sec)')
+    ax.set_ylabel('Pitch (midi note number)')
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5), handles=handle_list)
+    ax.set_title(jam.file_metadata.title)
+    ax.set_xlim(-0.5, jam.file_metadata.duration)
     if save_path:
-        plt.savefig(save_path)
-
-def visualize_jams_pt(jam, save_path=None):
-    style_dict = {0 : 'r', 1 : 'y', 2 : 'b', 3 : '#FF7F50', 4 : 'g', 5 : '#800080'}
-    string_dict = {0: 'E', 1: 'A', 2: 'D', 3: 'G', 4: 'B', 5: 'e' }
-    s = 0
+        fig.savefig(save_path)
+        if own_fig:
+            plt.close(fig)
+
+def visualize_jams_pt(jam, save_path=None, dpi=None, ax=None, dedup=False,
+                      xlim=None, ylim=None):
+    # draw into the given axes, or the current ones as before
+    if ax is None:
+        ax = plt.gca()
     handle_list = []
     # fig = plt.figure()
     annos_pt = jam.search(namespace='pitch_contour')
+    contours = []
+    for s, string_tran in enumerate(annos_pt):
+        handle_list.append(mlines.Line2D([], [], color=_STYLE[s],
+                                         label=_STRING[s]))
+        times = np.fromiter((o.time for o in string_tran.data),
+                            dtype=np.float64)
+        freqs = np.fromiter((o.value['frequency'] for o in string_tran.data),
+                            dtype=np.float64)
+        contours.append((times, librosa.hz_to_midi(freqs)))
+
+    # Optionally drop points sharing an output pixel. The grid is built
+    # from the view the caller will show (xlim / ylim, defaulting to the
+    # full duration and pitch span), so only use it for a fixed final view.
+    if dedup:
+        if xlim is None:
+            xlim = (-0.06, jam.file_metadata.duration)
+        grid_ylim = ylim
+        if grid_ylim is None:
+            all_pitches = np.concatenate([np.empty(0)] + [p for _, p in contours])
+            all_pitches = all_pitches[np.isfinite(all_pitches)]
+            grid_ylim = ((all_pitches.min(), all_pitches.max())
+                         if all_pitches.size else (0.0, 1.0))
+        bbox = ax.get_window_extent()
+        scale = float(dpi) / ax.figure.dpi if dpi else 1.0
+        x_px = (xlim[1] - xlim[0]) / max(bbox.width * scale, 1.0)
+        y_px = (grid_ylim[1] - grid_ylim[0]) / max(bbox.height * scale, 1.0)
+        if y_px <= 0:
+            y_px = 1.0
+
     # plot pitch
-    for string_tran in annos_pt:
-        handle_list.append(mlines.Line2D([], [], color=style_dict[s],
-                                         label=string_dict[s]))
-        df = string_tran.to_dataframe()
-        pitch_s = df.value.apply(
-            lambda x: librosa.hz_to_midi(float(x['frequency'])))
-        pitch_s.name = 'pitch'
-        df = pd.concat([df, pitch_s], axis=1)
-        plt.scatter(df.time, df.pitch, s=0.1, color=style_dict[s],
-                        label=string_dict[s])
-
-        s += 1
+    for s, (times, pitches) in enumerate(contours):
+        if dedup:
+            times, pitches = _unique_pixels(times, pitches, x_px, y_px)
+        # rasterize the point cloud, keep axes and labels vector
+        ax.scatter(times, pitches, s=0.1, color=_STYLE[s],
+                        label=_STRING[s], rasterized=True)
+
 
     # plot Beat
     anno_b = jam.search(namespace='beat_position')[0]
@@ -110,113 +204,97 @@ def visualize_jams_pt(jam, save_path=None):
                                          label='downbeat'))
     handle_list.append(mlines.Line2D([], [], color='k', linestyle='dotted',
                                      label='beat'))
-    for b in anno_b.data:
-        t = b.time
-        plt.axvline(t, linestyle='dotted', color='k', alpha=0.5)
-        if int(b.value['position']) == 1:
-            plt.axvline(t, linestyle='-', color='k', alpha=0.8)
+    plot_beat_lines(ax, anno_b)
 
 
     # plt.xlabel('Time (sec)')
-    plt.ylabel('Pitch Contour (midi note number)')
+    ax.set_ylabel('Pitch Contour (midi note number)')
     # plt.legend(loc='center left', bbox_to_anchor=(1, 0.5), handles=handle_list)
-    plt.title(jam.file_metadata.title)
-    plt.xlim(-0.06, jam.file_metadata.duration)
+    ax.set_title(jam.file_metadata.title)
+    ax.set_xlim(xlim if xlim is not None else (-0.06, jam.file_metadata.duration))
+    if ylim is not None:
+        ax.set_ylim(ylim)
     # fig.set_size_inches(6, 3)
     if save_path:
-        plt.savefig(save_path)
+        ax.figure.savefig(save_path, dpi=dpi)
 
-def visualize_jams_onset(jam, save_path=None, low=None, high=None):
-    style_dict = {0 : 'r', 1 : 'y', 2 : 'b', 3 : '#FF7F50', 4 : 'g', 5 : '#800080'}
-    string_dict = {0: 'E', 1: 'A', 2: 'D', 3: 'G', 4: 'B', 5: 'e' }
-    s = 0
+def visualize_jams_onset(jam, save_path=None, low=None, high=None, ax=None):
+    # draw into the given axes, or the current ones as before
+    if ax is None:
+        ax = plt.gca()
     handle_list = []
     # fig = plt.figure()
-    annos = jam.search(namespace='note_midi')
-    if len(annos) == 0:
-        annos = jam.search(namespace='pitch_midi')
-    for string_tran in annos:
-        handle_list.append(mlines.Line2D([], [], color=style_dict[s],
-                                         label=string_dict[s]))
-        for note in string_tran:
-            
-            start_time = note[0]
-            if low and start_time < low:
-                continue
-            if high and start_time > high:
-                continue
-            plt.vlines(start_time,s, s+2,style_dict[s], label=string_dict[s])
-        s += 1
+    annos = note_annotations(jam)
+    for s, string_tran in enumerate(annos):
+        handle_list.append(mlines.Line2D([], [], color=_STYLE[s],
+                                         label=_STRING[s]))
+        times, _, _ = _anno_arrays(string_tran)
+        in_range = np.ones_like(times, dtype=bool)
+        if low:
+            in_range &= times >= low
+        if high:
+            in_range &= times <= high
+        ax.vlines(times[in_range], s, s+2, _STYLE[s], label=_STRING[s])
     
-    plt.xlabel('sec')
-    plt.legend(loc='center left', bbox_to_anchor=(1, 0.5), handles=handle_list)
-    plt.ylabel('String Number')
+    ax.set_xlabel('sec')
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5), handles=handle_list)
+    ax.set_ylabel('String Number')
 
     if not low:
         low = -0.1
     if not high:
         high = jam.file_metadata.duration
-    plt.xlim(low, high)
+    ax.set_xlim(low, high)
     # fig.set_size_inches(jam.file_metadata.duration / 2.5, 6)
-#    plt.title('Onsets of Individual Strings for excerpt of 00_Rock2-142-D_comp')
+#    ax.set_title('Onsets of Individual Strings for excerpt of 00_Rock2-142-D_comp')
     if save_path:
-        plt.savefig(save_path)
+        ax.figure.savefig(save_path)
 
 
-def tablaturize_jams(jam, save_path=None):
-    str_midi_dict = {0: 40, 1: 45, 2: 50, 3: 55, 4: 59, 5: 64}
-    string_dict = {0: 'E', 1: 'A', 2: 'D', 3: 'G', 4: 'B', 5: 'e'}
-    style_dict = {0 : 'r', 1 : 'y', 2 : 'b', 3 : '#FF7F50', 4 : 'g', 5 : '#800080'}
-    s = 0
-
+def tablaturize_jams(jam, save_path=None, ax=None):
+    # draw into the given axes, or the current ones as before
+    if ax is None:
+        ax = plt.gca()
     handle_list = []
 
-    annos = jam.search(namespace='note_midi')
-    if len(annos) == 0:
-        annos = jam.search(namespace='pitch_midi')
+    annos = note_annotations(jam)
 
-    for string_tran in annos:
-        handle_list.append(mlines.Line2D([], [], color=style_dict[s],
-                                         label=string_dict[s]))
-        for note in string_tran:
-            start_time = note[0]
-            midi_note = note[2]
-            fret = int(round(midi_note - str_midi_dict[s]))
-            plt.scatter(start_time, s+1, marker="${}$".format(fret), color =
-            style_dict[s])
-        s += 1
+    for s, string_tran in enumerate(annos):
+        handle_list.append(mlines.Line2D([], [], color=_STYLE[s],
+                                         label=_STRING[s]))
+        starts, _, midis = _anno_arrays(string_tran)
+        frets = np.rint(midis - _STR_MIDI[s]).astype(int)
+        # one scatter per (string, fret) instead of one per note
+        for fret in np.unique(frets):
+            times = starts[frets == fret]
+            ax.scatter(times, np.full(len(times), s+1),
+                        marker=_fret_marker(fret), color=_STYLE[s])
 
     # plot Beat
     anno_b = jam.search(namespace='beat_position')[0]
-    for b in anno_b.data:
-        t = b.time
-        plt.axvline(t, linestyle='dotted', color='k', alpha=0.5)
-        if int(b.value['position']) == 1:
-            plt.axvline(t, linestyle='-', color='k', alpha=0.8)
+    plot_beat_lines(ax, anno_b)
 
     handle_list.append(mlines.Line2D([], [], color='k',
                                      label='downbeat'))
     handle_list.append(mlines.Line2D([], [], color='k', linestyle='dotted',
                                      label='beat'))
-    plt.xlabel('Time (sec)')
-    plt.ylabel('String Number')
+    ax.set_xlabel('Time (sec)')
+    ax.set_ylabel('String Number')
     # plt.title(jam.file_metadata.title)
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.2),
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.2),
                handles=handle_list, ncol=8)
-    plt.xlim(-0.5, jam.file_metadata.duration)
+    ax.set_xlim(-0.5, jam.file_metadata.duration)
     # fig.set_size_inches(6, 3)
     if save_path:
-        plt.savefig(save_path)
+        ax.figure.savefig(save_path)
 
-def visualize_chords(jam, save_path=None):
+def visualize_chords(jam, save_path=None, ax=None):
+    # draw into the given axes, or the current ones as before
+    if ax is None:
+        ax = plt.gca()
 
     chord_ann = jam.search(namespace='chord')[1]
 
-
-    for chord in chord_ann.data:
-        t = chord.time
-
-
     # for string_tran in annos:
     #     for note in string_tran:
     #         start_time = note[0]
@@ -235,13 +313,15 @@ def visualize_chords(jam, save_path=None):
     #         plt.axvline(t, linestyle='-', color='k', alpha=0.8)
 
 
-    plt.xlabel('Time (sec)')
-    plt.ylabel('String Number')
+    ax.set_xlabel('Time (sec)')
+    ax.set_ylabel('String Number')
     # plt.title(jam.file_metadata.title)
-    plt.xlim(-0.5, jam.file_metadata.duration)
+    ax.set_xlim(-0.5, jam.file_metadata.duration)
+    # chord labels, placed once the x range is final
+    add_annotations(ax, chord_ann, ygrow_ratio=0.1)
     # fig.set_size_inches(6, 3)
     if save_path:
-        plt.savefig(save_path)
+        ax.figure.savefig(save_path)
 
 def add_annotations_to_barline(ax, annotations, beat_annotations,
                                ygrow_ratio=1, label_xoffset=0, label_yoffset=0):
@@ -270,11 +350,15 @@ def add_annotations_to_barline(ax, annotations, beat_annotations,
     x_min, x_max = ax.get_xlim()
     y_min, y_max = ax.get_ylim()
     ax.set_ylim(y_min, y_max+(y_max-y_min)*ygrow_ratio) # make room for label
-    for beat in beat_annotations:
-        if beat.value['position'] == 1 and beat.time >= x_min and beat.time < x_max:
-            ax.text(beat.time+label_xoffset, y_max-label_yoffset,
-                    annotations.to_samples([beat.time+0.001])[0][0],
-                    fontdict={'backgroundcolor': ax.get_facecolor()})
+    times = [beat.time for beat in beat_annotations
+             if beat.value['position'] == 1 and beat.time >= x_min and beat.time < x_max]
+    if not times:
+        return
+    # sample all labels in one pass over the annotation
+    samples = annotations.to_samples([t+0.001 for t in times])
+    for t, sample in zip(times, samples):
+        ax.text(t+label_xoffset, y_max-label_yoffset, sample[0],
+                fontdict={'backgroundcolor': ax.get_facecolor()})
 
 def add_annotations(ax, annotations,
                     ygrow_ratio=0, label_xoffset=0, label_yoffset=0):
@@ -300,8 +384,12 @@ def add_annotations(ax, annotations,
     x_min, x_max = ax.get_xlim()
     y_min, y_max = ax.get_ylim()
     ax.set_ylim(y_min, y_max+(y_max-y_min)*ygrow_ratio) # make room for label
-    for segment in annotations:
-        if segment.time >= x_min and segment.time < x_max:
-            ax.text(segment.time+label_xoffset, y_max-label_yoffset,
-                    annotations.to_samples([segment.time+0.001])[0][0],
-                    fontdict={'backgroundcolor': ax.get_facecolor()})
+    times = [segment.time for segment in annotations
+             if segment.time >= x_min and segment.time < x_max]
+    if not times:
+        return
+    # sample all labels in one pass over the annotation
+    samples = annotations.to_samples([t+0.001 for t in times])
+    for t, sample in zip(times, samples):
+        ax.text(t+label_xoffset, y_max-label_yoffset, sample[0],
+                fontdict={'backgroundcolor': ax.get_facecolor()})